@@ -4,11 +4,323 @@ from datetime import datetime
 from typing import Optional, List, Dict, Any
 import sqlite3
 import json
-import hashlib
+import secrets
+from blake3 import blake3
 import zlib
+import struct
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 from pathlib import Path
 import sys
 import os
+import math
+import threading
+import re
+import fnmatch
+
+# Compiled (Cython) FastCDC from the fastcdc package; its pure-Python
+# fallback is far too slow for the backup hot path
+from fastcdc.fastcdc_cy import fastcdc_cy as _cdc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bytes read per chunking window; anything past a window's last full cut
+# is carried into the next one
+CDC_WINDOW = 8 * 1024 * 1024
+
+def fastcdc(file_path, min_size: int, avg_size: int, max_size: int, fat: bool = False):
+    """Yield (offset, length, data) content-defined chunks of a file (FastCDC).
+
+    The file is read in CDC_WINDOW pieces rather than mmapped: a file
+    truncated mid-backup just reads short instead of raising SIGBUS. With
+    ``fat`` the data is a memoryview into the current window.
+    """
+    with open(file_path, 'rb') as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf, base = b"", 0
+        while True:
+            block = f.read(CDC_WINDOW)
+            eof = len(block) < CDC_WINDOW
+            buf = buf + block if buf else block
+            if not buf:
+                return
+            chunks = list(_cdc(buf, min_size, avg_size, max_size))
+            if not eof:
+                chunks.pop()  # may be cut short by the window edge; re-chunk it
+            view = memoryview(buf)
+            for chunk in chunks:
+                data = view[chunk.offset:chunk.offset + chunk.length] if fat else None
+                yield base + chunk.offset, chunk.length, data
+            if eof:
+                return
+            consumed = chunks[-1].offset + chunks[-1].length if chunks else 0
+            buf, base = buf[consumed:], base + consumed
+
+def chunk_and_hash(path: str, min_size: int, avg_size: int, max_size: int):
+    """Yield (offset, length, BLAKE3 digest) for each chunk of a file."""
+    for offset, length, data in fastcdc(path, min_size, avg_size, max_size, fat=True):
+        yield offset, length, blake3(data).digest()
+
+def pack_refs(refs: Dict[bytes, int]) -> bytes:
+    """Pack digest -> count refs as N x (32-byte digest || uint32 LE count)."""
+    return b"".join(digest + count.to_bytes(4, "little") for digest, count in refs.items())
+
+def unpack_refs(data: bytes):
+    """Iterate (digest, count) pairs from a pack_refs() blob."""
+    return struct.iter_unpack('<32sI', data)
+
+# Chunk objects start with a one-byte codec tag so restore needs no job
+# context (chunks are shared across jobs and the fallback codec can vary)
+OBJ_RAW, OBJ_ZSTD, OBJ_LZ4, OBJ_ZLIB = b"\x00", b"\x01", b"\x02", b"\x03"
+
+@lru_cache(maxsize=None)
+def _get_compressor(name: str, zstd_dict: bytes = None):
+    """Return (object tag, compress function) for a job's compression setting."""
+    # Cached per process: zstd context setup is not free per chunk
+    if name == "zstd" and zstandard is not None:
+        dict_data = zstandard.ZstdCompressionDict(zstd_dict) if zstd_dict else None
+        return OBJ_ZSTD, zstandard.ZstdCompressor(level=3, dict_data=dict_data).compress
+    if name == "lz4" and lz4 is not None:
+        return OBJ_LZ4, lz4.frame.compress
+    if name == "none":
+        return OBJ_RAW, bytes
+    return OBJ_ZLIB, lambda data: zlib.compress(data, 1)
+
+def _object_decompressors(zstd_dicts: List[bytes]) -> Dict[bytes, Any]:
+    """Map object tags to decompress functions; zstd frames pick their dict by ID."""
+    decompress = {OBJ_ZLIB: zlib.decompress}
+    if lz4 is not None:
+        decompress[OBJ_LZ4] = lz4.frame.decompress
+    if zstandard is not None:
+        by_id = {0: zstandard.ZstdDecompressor()}
+        for raw in zstd_dicts:
+            dict_data = zstandard.ZstdCompressionDict(raw)
+            by_id[dict_data.dict_id()] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        decompress[OBJ_ZSTD] = lambda data: by_id[zstandard.get_frame_parameters(data).dict_id].decompress(data)
+    return decompress
+
+def _fsync_dir(path):
+    """Make a directory's entries (new or renamed files) durable."""
+    if os.name != "posix":
+        return  # directories cannot be opened for fsync elsewhere
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_object(path: Path, obj: bytes):
+    """Write an object file durably: temp file, fsync, rename into place.
+
+    A crash leaves either the old file or the complete new one, never a
+    torn object under a digest name. The caller fsyncs the directory.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(obj)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# What decoding a torn or corrupt object can raise: KeyError for an empty
+# object, an unknown tag or an unknown zstd dict, RuntimeError from LZ4F
+DECODE_ERRORS = (KeyError, RuntimeError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+def _write_all(fd: int, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _walk_files(source_paths: List[str], exclude_patterns: List[str] = None) -> List[str]:
+    # All fnmatch patterns compiled into one regex, matched once per path
+    excluded = None
+    if exclude_patterns:
+        excluded = re.compile('|'.join(fnmatch.translate(p) for p in exclude_patterns)).match
+    files = []
+    for src_path in source_paths:
+        # Absolute, so recorded paths do not depend on the cwd of the run
+        src_path = os.path.abspath(src_path)
+        if Path(src_path).exists():
+            for root, dirs, names in os.walk(src_path):
+                if excluded:
+                    # Prune excluded directories so their subtrees are never walked
+                    dirs[:] = [d for d in dirs if not excluded(os.path.join(root, d))]
+                    names = [n for n in names if not excluded(os.path.join(root, n))]
+                files.extend(os.path.join(root, name) for name in names)
+    return files
+
+def _train_zstd_dict(paths: List[str], dict_size: int, sample_size: int, max_bytes: int) -> Optional[bytes]:
+    """Train a zstd dictionary on chunk-sized samples of up to max_bytes of data."""
+    if zstandard is None:
+        return None
+    samples = []
+    total = 0
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                while total < max_bytes:
+                    sample = f.read(sample_size)
+                    if not sample:
+                        break
+                    samples.append(sample)
+                    total += len(sample)
+        except OSError:
+            continue
+        if total >= max_bytes:
+            break
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError:
+        return None  # too little (or too uniform) data to train on
+
+def _make_object(tag: bytes, compress, data) -> bytes:
+    """Build a stored object (codec tag + payload) from chunk data."""
+    compressed = compress(data)
+    if len(compressed) < len(data):
+        return tag + compressed
+    return OBJ_RAW + data  # incompressible: store raw
+
+def _object_path(objects_path: Path, digest: bytes) -> Path:
+    return objects_path / digest[:1].hex() / digest.hex()
+
+# Filter over the chunks stored when the pool started, set in each worker
+# by _init_worker. A chunk it has never seen is certainly new.
+_stored_hint = frozenset()
+
+def _init_worker(stored):
+    global _stored_hint
+    _stored_hint = stored
+
+def _backup_file(path: str, objects_path: Path, compression: str, min_size: int, avg_size: int,
+                 max_size: int, zstd_dict: bytes = None):
+    """Chunk, hash and store one file; runs in a worker process.
+
+    Chunks missing from the stored-chunk filter are compressed from the
+    buffer they were hashed from and written to the object store. Others
+    may be stored already; the parent checks them.
+
+    Returns (lengths, digests, written) in file order: an array of chunk
+    lengths, the concatenated 32-byte digests, and digest -> (length,
+    compressed size) for the objects written.
+    """
+    tag, compress = _get_compressor(compression, zstd_dict)
+    lengths, digests, written = array('I'), [], {}
+    for _, length, data in fastcdc(path, min_size, avg_size, max_size, fat=True):
+        digest = blake3(data).digest()
+        if digest not in written and digest not in _stored_hint:
+            obj = _make_object(tag, compress, data)
+            _write_object(_object_path(objects_path, digest), obj)
+            written[digest] = (length, len(obj))
+        lengths.append(length)
+        digests.append(digest)
+    return lengths, b"".join(digests), written
+
+def _store_chunks(path: str, segments: List[tuple], objects_path: Path, compression: str,
+                  zstd_dict: bytes = None):
+    """Read, compress and store the given (offset, length, digest) chunks of a file; runs in a worker process.
+
+    Each chunk is hashed again from the bytes it is compressed from. Returns
+    (stored, missed): (digest, length, compressed size) for the chunks
+    that still match their digest, and the digests of those that no longer
+    do because the file changed after it was hashed.
+    """
+    tag, compress = _get_compressor(compression, zstd_dict)
+    stored, missed = [], []
+    with open(path, 'rb') as f:
+        for offset, length, digest in segments:
+            data = os.pread(f.fileno(), length, offset)
+            if blake3(data).digest() == digest:
+                obj = _make_object(tag, compress, data)
+                _write_object(_object_path(objects_path, digest), obj)
+                stored.append((digest, length, len(obj)))
+            else:
+                missed.append(digest)
+    return stored, missed
+
+def _bounded_map(ex, fn, arg_tuples, window: int):
+    """Executor.map over argument tuples with at most window calls in flight.
+
+    Executor.map submits every call up front, so results finished out of
+    order pile up in memory while an earlier one is still running.
+    """
+    pending = deque()
+    for args in arg_tuples:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(ex.submit(fn, *args))
+    while pending:
+        yield pending.popleft().result()
+
+class ChunkBloom:
+    """Bloom filter over chunk digests, persisted next to the database.
+
+    Digests are already uniform, so the k probe positions are derived from
+    two 64-bit slices of the digest (double hashing) instead of rehashing.
+    """
+    HEADER = struct.Struct('<QQI')  # capacity, chunk generation, hash count
+    
+    def __init__(self, capacity: int, error_rate: float = 0.001, num_hashes: int = None, bits: bytearray = None):
+        self.capacity = capacity
+        if bits is None:
+            num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            bits = bytearray((num_bits + 7) // 8)
+            num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.bits = bits
+        self.num_bits = len(bits) * 8
+        self.num_hashes = num_hashes
+    
+    def _positions(self, digest: bytes):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+    
+    def add(self, digest: bytes):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+    
+    def save(self, path: Path, generation: int):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.capacity, generation, self.num_hashes))
+            f.write(self.bits)
+        os.replace(tmp, path)
+    
+    @classmethod
+    def load(cls, path: Path, generation: int, chunk_count: int) -> Optional["ChunkBloom"]:
+        """Load a saved filter, or None if missing, out of date or full."""
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        capacity, saved_generation, num_hashes = cls.HEADER.unpack_from(data)
+        # The generation is bumped whenever chunks are added, so a filter
+        # saved before an addition is stale; rebuild rather than risk false
+        # negatives
+        if saved_generation != generation or chunk_count > capacity:
+            return None
+        return cls(capacity, num_hashes=num_hashes, bits=bytearray(data[cls.HEADER.size:]))
 
 @dataclass
 class BackupJob:
@@ -18,125 +330,324 @@ class BackupJob:
     exclude_patterns: List[str] = field(default_factory=list)
     destination: str = ""
     schedule: str = "daily"
-    compression: str = "lz4"
+    compression: str = "zstd"
     last_run: Optional[datetime] = None
     size_bytes: int = 0
     status: str = "idle"
+    zstd_dict: Optional[bytes] = None
 
 @dataclass
 class BackupChunk:
-    id: str
-    sha256: str
+    hash: bytes
     size: int
     compressed_size: int
-    references: Dict[str, int] = field(default_factory=dict)
+    refs: int = 0
 
 class BackupEngine:
-    CHUNK_SIZE = 4096
+    MIN_CHUNK_SIZE = 2 * 1024
+    AVG_CHUNK_SIZE = 8 * 1024
+    MAX_CHUNK_SIZE = 64 * 1024
+    # Above this many stored chunks, dedup checks go through a Bloom filter
+    # instead of an in-memory digest map (~80 bytes/chunk in a dict)
+    MAX_KNOWN_CHUNKS = 10_000_000
+    # zstd jobs get a dictionary trained on a sample of their sources; it
+    # replaces the cold-start entropy model that small chunks otherwise pay
+    ZSTD_DICT_SIZE = 16 * 1024
+    ZSTD_DICT_SAMPLE_BYTES = 100 * 1024 * 1024
+    # Rows per multi-VALUES chunk insert; 4 params each must fit in SQLite's
+    # bound-parameter limit (999 before 3.32)
+    CHUNK_INSERT_BATCH = 500 if sqlite3.sqlite_version_info >= (3, 32) else 249
+    # Bound parameters per single-column IN list, under the same limit
+    SQL_PARAM_BATCH = 999
+    # run_backup works through FILE_BATCH files at a time and hands workers
+    # at most STORE_TASK_BYTES of new chunk data per compression task
+    FILE_BATCH = 1024
+    STORE_TASK_BYTES = 16 * 1024 * 1024
     
     def __init__(self, db_path: str = None):
         if db_path is None:
             db_path = Path.home() / ".blackroad" / "backups.db"
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.bloom_path = self.db_path.with_name(self.db_path.name + ".bloom")
+        self.lock_path = self.db_path.with_name(self.db_path.name + ".lock")
+        # Content-addressed chunk store: objects/<first hex byte>/<digest hex>
+        self.objects_path = self.db_path.parent / "objects"
+        # One long-lived autocommit connection; sqlite3 caches its prepared
+        # statements, and the lock serializes use across threads
+        self._conn = self._connect()
+        self._lock = threading.Lock()
         self._init_db()
+        # Read-only methods get their own connection: under WAL they read the
+        # last commit instead of waiting for a backup holding the writer
+        self._read_conn = self._connect()
+        self._read_lock = threading.Lock()
+    
+    def close(self):
+        self._conn.close()
+        self._read_conn.close()
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        return conn
+    
+    @contextmanager
+    def _transaction(self, begin: str = 'BEGIN IMMEDIATE', read: bool = False):
+        conn, lock = (self._read_conn, self._read_lock) if read else (self._conn, self._lock)
+        with lock:
+            conn.execute(begin)
+            try:
+                yield conn.cursor()
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    
+    @contextmanager
+    def _repository_lock(self):
+        """Hold an exclusive lock on the repository across processes."""
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield  # closing the file releases the lock
     
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        c = self._conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS jobs (
             id TEXT PRIMARY KEY, name TEXT, source_paths TEXT, exclude_patterns TEXT,
             destination TEXT, schedule TEXT, compression TEXT, last_run REAL, 
-            size_bytes INTEGER, status TEXT)''')
+            size_bytes INTEGER, status TEXT, zstd_dict BLOB)''')
         c.execute('''CREATE TABLE IF NOT EXISTS backups (
             id TEXT PRIMARY KEY, job_id TEXT, timestamp REAL, size_bytes INTEGER,
-            dedup_ratio REAL, chunk_ids TEXT)''')
+            dedup_ratio REAL, chunk_ids BLOB)''')
+        # Per-file chunk sequence (concatenated digests) for restore
+        c.execute('''CREATE TABLE IF NOT EXISTS backup_files (
+            backup_id TEXT, path TEXT, chunks BLOB, PRIMARY KEY (backup_id, path)) WITHOUT ROWID''')
         c.execute('''CREATE TABLE IF NOT EXISTS chunks (
-            id TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, compressed_size INTEGER, references TEXT)''')
-        conn.commit()
-        conn.close()
+            hash BLOB PRIMARY KEY, size INTEGER, compressed_size INTEGER, refs INTEGER DEFAULT 0)
+            WITHOUT ROWID''')
+        # chunk_generation: bumped whenever chunks are added
+        c.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
     
     def create_job(self, name: str, source_paths: List[str], destination: str,
-                   exclude_patterns: List[str] = None, compression: str = "lz4", 
+                   exclude_patterns: List[str] = None, compression: str = "zstd", 
                    schedule: str = "daily") -> str:
         exclude_patterns = exclude_patterns or []
-        job_id = hashlib.md5(f"{name}{datetime.utcnow().isoformat()}".encode()).hexdigest()[:12]
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (job_id, name, json.dumps(source_paths), json.dumps(exclude_patterns),
-                   destination, schedule, compression, None, 0, "idle"))
-        conn.commit()
-        conn.close()
+        source_paths = [os.path.abspath(p) for p in source_paths]
+        job_id = secrets.token_hex(6)
+        zstd_dict = None
+        if compression == "zstd":
+            zstd_dict = _train_zstd_dict(_walk_files(source_paths, exclude_patterns), self.ZSTD_DICT_SIZE,
+                                         self.AVG_CHUNK_SIZE, self.ZSTD_DICT_SAMPLE_BYTES)
+        with self._lock:
+            self._conn.execute('''INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                               (job_id, name, json.dumps(source_paths), json.dumps(exclude_patterns),
+                                destination, schedule, compression, None, 0, "idle", zstd_dict))
         return job_id
     
     def run_backup(self, job_id: str) -> str:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
-        job_row = c.fetchone()
-        if not job_row:
-            conn.close()
-            return None
-        
-        source_paths = json.loads(job_row[2])
-        backup_id = hashlib.md5(f"{job_id}{datetime.utcnow().isoformat()}".encode()).hexdigest()[:12]
-        chunks_used = {}
-        total_size = 0
-        compressed_size = 0
-        
-        for src_path in source_paths:
-            if Path(src_path).exists():
-                for root, dirs, files in os.walk(src_path):
-                    for file in files:
-                        file_path = Path(root) / file
-                        with open(file_path, 'rb') as f:
-                            while True:
-                                chunk_data = f.read(self.CHUNK_SIZE)
-                                if not chunk_data:
-                                    break
-                                sha256 = hashlib.sha256(chunk_data).hexdigest()
-                                total_size += len(chunk_data)
-                                
-                                # Check if chunk exists
-                                c.execute('SELECT compressed_size FROM chunks WHERE sha256 = ?', (sha256,))
-                                existing = c.fetchone()
-                                
-                                if existing:
-                                    chunks_used[sha256] = chunks_used.get(sha256, 0) + 1
-                                    compressed_size += existing[0]
-                                else:
-                                    # Compress and store
-                                    try:
-                                        compressed = zlib.compress(chunk_data, 6)
-                                    except:
-                                        compressed = chunk_data
-                                    
-                                    chunk_id = f"chunk_{sha256[:8]}"
-                                    c.execute('''INSERT INTO chunks VALUES (?, ?, ?, ?, ?)''',
-                                             (chunk_id, sha256, len(chunk_data), len(compressed), json.dumps({})))
-                                    chunks_used[sha256] = 1
-                                    compressed_size += len(compressed)
-        
-        dedup_ratio = compressed_size / total_size if total_size > 0 else 0
-        c.execute('''INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)''',
-                  (backup_id, job_id, datetime.utcnow().timestamp(), total_size, dedup_ratio, json.dumps(chunks_used)))
-        c.execute('UPDATE jobs SET last_run = ?, size_bytes = ?, status = ? WHERE id = ?',
-                  (datetime.utcnow().timestamp(), total_size, "completed", job_id))
-        conn.commit()
-        conn.close()
-        return backup_id
+        # Excludes a concurrent prune (or backup) in another process
+        with self._repository_lock():
+            # One transaction (one fsync) for the whole backup
+            with self._transaction() as c:
+                c.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+                job_row = c.fetchone()
+                if not job_row:
+                    return None
+                
+                source_paths = json.loads(job_row[2])
+                backup_id = secrets.token_hex(6)
+                chunk_count = c.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+                generation = self._chunk_generation(c)
+                # Every stored chunk is in the filter. Workers get a copy to
+                # spot chunks that are certainly new and compress those in the
+                # same pass as hashing them
+                bloom = self._load_bloom(c, generation, chunk_count)
+                in_memory = chunk_count <= self.MAX_KNOWN_CHUNKS
+                if in_memory:
+                    # Digest -> compressed size for every stored chunk; O(1) dedup checks
+                    known = dict(c.execute('SELECT hash, compressed_size FROM chunks'))
+                else:
+                    # Too many to hold: screen with the filter and confirm hits in
+                    # SQL; known only tracks chunks this backup has looked up or added
+                    known = {}
+                chunks_used = {}
+                new_chunks = []
+                total_size = 0
+                compressed_size = 0
+                
+                def lookup(digest):
+                    """Compressed size of a stored chunk, or None if it is new."""
+                    size = known.get(digest)
+                    if size is None and not in_memory and digest in bloom:
+                        row = c.execute('SELECT compressed_size FROM chunks WHERE hash = ?', (digest,)).fetchone()
+                        if row:
+                            size = known[digest] = row[0]
+                    return size
+                
+                def record(digest, length, csize):
+                    new_chunks.append((digest, length, csize))
+                    known[digest] = csize
+                    bloom.add(digest)
+                
+                def store_file(path):
+                    """Chunk, hash and store one file in a single pass over each buffer."""
+                    lengths, digests = array('I'), []
+                    for _, length, data in fastcdc(path, self.MIN_CHUNK_SIZE, self.AVG_CHUNK_SIZE,
+                                                   self.MAX_CHUNK_SIZE, fat=True):
+                        digest = blake3(data).digest()
+                        if lookup(digest) is None:
+                            obj = _make_object(tag, compress, data)
+                            self._write_object(digest, obj)
+                            record(digest, length, len(obj))
+                        lengths.append(length)
+                        digests.append(digest)
+                    return lengths, b"".join(digests)
+                
+                # Files are independent: workers chunk, hash and store them, and
+                # this process keeps all database work. A chunk the filter has
+                # seen but the store lacks (a false positive) is read again and
+                # stored in a second, rare pass. Files go through in batches so
+                # memory stays bounded.
+                tag, compress = _get_compressor(job_row[6], job_row[10])
+                backer = partial(_backup_file, objects_path=self.objects_path, compression=job_row[6],
+                                 min_size=self.MIN_CHUNK_SIZE, avg_size=self.AVG_CHUNK_SIZE,
+                                 max_size=self.MAX_CHUNK_SIZE, zstd_dict=job_row[10])
+                storer = partial(_store_chunks, objects_path=self.objects_path, compression=job_row[6],
+                                 zstd_dict=job_row[10])
+                paths = _walk_files(source_paths, json.loads(job_row[3]))
+                workers = os.cpu_count() or 1
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(bloom,)) as ex:
+                    for i in range(0, len(paths), self.FILE_BATCH):
+                        batch = paths[i:i + self.FILE_BATCH]
+                        manifests = []
+                        # Each chunk still missing is claimed by its first
+                        # occurrence in the batch, in tasks of bounded size
+                        tasks, claimed = [], set()
+                        results = _bounded_map(ex, backer, ((path,) for path in batch), 2 * workers)
+                        for path, (lengths, digests, written) in zip(batch, results):
+                            manifests.append((lengths, digests))
+                            for digest, (length, csize) in written.items():
+                                # Other files' workers may have written it too
+                                if lookup(digest) is None:
+                                    record(digest, length, csize)
+                            segments, task_bytes, offset = [], 0, 0
+                            for length, (digest,) in zip(lengths, struct.iter_unpack('32s', digests)):
+                                if digest not in claimed and lookup(digest) is None:
+                                    claimed.add(digest)
+                                    segments.append((offset, length, digest))
+                                    task_bytes += length
+                                    if task_bytes >= self.STORE_TASK_BYTES:
+                                        tasks.append((path, segments))
+                                        segments, task_bytes = [], 0
+                                offset += length
+                            if segments:
+                                tasks.append((path, segments))
+                        missed = set()
+                        for stored, task_missed in _bounded_map(ex, storer, tasks, 2 * workers):
+                            for digest, length, csize in stored:
+                                record(digest, length, csize)
+                            missed.update(task_missed)
+                        
+                        files = []
+                        for path, (lengths, digests) in zip(batch, manifests):
+                            if missed and any(digest in missed for (digest,) in struct.iter_unpack('32s', digests)):
+                                # A chunk changed between hashing and storing; redo the
+                                # file here, hashing and compressing the same bytes
+                                lengths, digests = store_file(path)
+                            files.append((backup_id, path, digests))
+                            for length, (digest,) in zip(lengths, struct.iter_unpack('32s', digests)):
+                                total_size += length
+                                compressed_size += known[digest]
+                                chunks_used[digest] = chunks_used.get(digest, 0) + 1
+                        c.executemany('INSERT INTO backup_files VALUES (?, ?, ?)', files)
+                
+                # A redone file can leave chunks stored from contents it no longer has
+                for digest, _, _ in new_chunks:
+                    if digest not in chunks_used:
+                        self._object_path(digest).unlink(missing_ok=True)
+                new_chunks = [row for row in new_chunks if row[0] in chunks_used]
+                # refs counts every occurrence across all backups; prune decrements it
+                self._insert_chunks(c, [(digest, size, csize, chunks_used[digest])
+                                        for digest, size, csize in new_chunks])
+                new_digests = {row[0] for row in new_chunks}
+                c.executemany('UPDATE chunks SET refs = refs + ? WHERE hash = ?',
+                              ((n, digest) for digest, n in chunks_used.items() if digest not in new_digests))
+                dedup_ratio = compressed_size / total_size if total_size > 0 else 0
+                c.execute('''INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)''',
+                          (backup_id, job_id, datetime.utcnow().timestamp(), total_size, dedup_ratio,
+                           pack_refs(chunks_used)))
+                c.execute('UPDATE jobs SET last_run = ?, size_bytes = ?, status = ? WHERE id = ?',
+                          (datetime.utcnow().timestamp(), total_size, "completed", job_id))
+                if new_chunks:
+                    generation = self._bump_chunk_generation(c)
+                # Rows may only commit once the objects they name are on disk
+                self._sync_objects(new_digests)
+            bloom.save(self.bloom_path, generation)
+            return backup_id
+    
+    def _object_path(self, digest: bytes) -> Path:
+        return _object_path(self.objects_path, digest)
+    
+    def _write_object(self, digest: bytes, obj: bytes):
+        _write_object(self._object_path(digest), obj)
+    
+    def _sync_objects(self, digests):
+        """fsync the object directories holding digests; call before COMMIT."""
+        shards = {digest[:1].hex() for digest in digests}
+        for shard in shards:
+            _fsync_dir(self.objects_path / shard)
+        if shards:
+            _fsync_dir(self.objects_path)
+    
+    def _insert_chunks(self, c: sqlite3.Cursor, rows: List[tuple]):
+        # Unrolled multi-row INSERT: one statement execution per CHUNK_INSERT_BATCH rows.
+        # A chunk that turns out to be stored already gets its refs added
+        # rather than the row silently dropped
+        upsert = ' ON CONFLICT(hash) DO UPDATE SET refs = refs + excluded.refs'
+        batch = self.CHUNK_INSERT_BATCH
+        stmt = 'INSERT INTO chunks VALUES ' + ', '.join(['(?, ?, ?, ?)'] * batch) + upsert
+        full = len(rows) - len(rows) % batch
+        for i in range(0, full, batch):
+            c.execute(stmt, list(chain.from_iterable(rows[i:i + batch])))
+        c.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?)' + upsert, rows[full:])
+    
+    def _chunk_generation(self, c: sqlite3.Cursor) -> int:
+        row = c.execute("SELECT value FROM meta WHERE key = 'chunk_generation'").fetchone()
+        return row[0] if row else 0
+    
+    def _bump_chunk_generation(self, c: sqlite3.Cursor) -> int:
+        # Invalidates saved Bloom filters; call in the transaction that
+        # adds chunks
+        c.execute('''INSERT INTO meta VALUES ('chunk_generation', 1)
+                     ON CONFLICT(key) DO UPDATE SET value = value + 1''')
+        return self._chunk_generation(c)
+    
+    def _load_bloom(self, c: sqlite3.Cursor, generation: int, chunk_count: int) -> ChunkBloom:
+        bloom = ChunkBloom.load(self.bloom_path, generation, chunk_count)
+        if bloom is None:
+            bloom = ChunkBloom(max(2 * chunk_count, 1 << 20))
+            for (digest,) in c.execute('SELECT hash FROM chunks'):
+                bloom.add(digest)
+        return bloom
     
     def list_backups(self, job_id: str = None) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        if job_id:
-            c.execute('SELECT * FROM backups WHERE job_id = ? ORDER BY timestamp DESC', (job_id,))
-        else:
-            c.execute('SELECT * FROM backups ORDER BY timestamp DESC')
+        with self._read_lock:
+            c = self._read_conn.cursor()
+            if job_id:
+                c.execute('SELECT * FROM backups WHERE job_id = ? ORDER BY timestamp DESC', (job_id,))
+            else:
+                c.execute('SELECT * FROM backups ORDER BY timestamp DESC')
+            rows = c.fetchall()
         
         results = []
-        for row in c.fetchall():
+        for row in rows:
             results.append({
                 "id": row[0],
                 "job_id": row[1],
@@ -144,79 +655,137 @@ class BackupEngine:
                 "size_bytes": row[3],
                 "dedup_ratio": row[4]
             })
-        conn.close()
         return results
     
     def restore(self, backup_id: str, output_dir: str) -> bool:
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT chunk_ids FROM backups WHERE id = ?', (backup_id,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
-            return False
+        # One read transaction, so the files and dicts come from the same commit
+        with self._transaction('BEGIN', read=True) as c:
+            c.execute('SELECT 1 FROM backups WHERE id = ?', (backup_id,))
+            if not c.fetchone():
+                return False
+            c.execute('SELECT path, chunks FROM backup_files WHERE backup_id = ?', (backup_id,))
+            files = c.fetchall()
+            c.execute('SELECT zstd_dict FROM jobs WHERE zstd_dict IS NOT NULL')
+            zstd_dicts = [row[0] for row in c.fetchall()]
         
-        chunk_refs = json.loads(row[0])
-        for sha256, count in chunk_refs.items():
-            c.execute('SELECT sha256, size FROM chunks WHERE sha256 = ?', (sha256,))
-            chunk = c.fetchone()
-            if chunk:
-                restored_path = Path(output_dir) / f"restored_{sha256[:8]}"
-                with open(restored_path, 'wb') as f:
-                    f.write(b"CHUNK_DATA_PLACEHOLDER")
+        out_root = Path(output_dir).resolve()
+        targets = []
+        for path, chunks in files:
+            rel_path = Path(path).relative_to(Path(path).anchor)
+            out_path = out_root / rel_path
+            # Every file must land under output_dir: no '..' segments, and no
+            # symlink already in output_dir leading out of it
+            if '..' in rel_path.parts or not out_path.resolve().is_relative_to(out_root):
+                return False
+            targets.append((out_path, chunks))
         
-        conn.close()
+        decompress = _object_decompressors(zstd_dicts)
+        for out_path, chunks in targets:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            fd_out = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                for (digest,) in struct.iter_unpack('32s', chunks):
+                    try:
+                        obj = self._object_path(digest).read_bytes()
+                    except FileNotFoundError:
+                        return False
+                    try:
+                        data = memoryview(obj)[1:] if obj[:1] == OBJ_RAW else decompress[obj[:1]](obj[1:])
+                    except DECODE_ERRORS:
+                        return False  # empty, unknown tag or corrupt payload
+                    # Objects are named by their content hash; refuse to
+                    # restore one that does not match it
+                    if blake3(data).digest() != digest:
+                        return False
+                    _write_all(fd_out, data)
+            finally:
+                os.close(fd_out)
         return True
     
     def prune(self, job_id: str, keep_daily: int = 7, keep_weekly: int = 4, keep_monthly: int = 12) -> int:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT id FROM backups WHERE job_id = ? ORDER BY timestamp DESC', (job_id,))
-        backups = [r[0] for r in c.fetchall()]
-        
-        # Simple: keep last N backups
-        to_delete = backups[keep_daily + keep_weekly + keep_monthly:]
-        for backup_id in to_delete:
-            c.execute('DELETE FROM backups WHERE id = ?', (backup_id,))
-        
-        conn.commit()
-        conn.close()
-        return len(to_delete)
+        # Held until the orphans are unlinked, so no backup in another process
+        # can dedup against an object that is about to go
+        with self._repository_lock():
+            with self._transaction() as c:
+                c.execute('SELECT id, timestamp FROM backups WHERE job_id = ? ORDER BY timestamp DESC', (job_id,))
+                backups = c.fetchall()
+                
+                # Grandfather-father-son, as in Borg: each rule keeps the newest backup
+                # of its last N periods; a period whose newest backup an earlier rule
+                # already kept is used up without counting
+                keep = set()
+                for period_fmt, keep_n in (("%Y-%m-%d", keep_daily), ("%G-%V", keep_weekly), ("%Y-%m", keep_monthly)):
+                    kept, last_period = 0, None
+                    for backup_id, timestamp in backups:
+                        if kept >= keep_n:
+                            break
+                        period = datetime.fromtimestamp(timestamp).strftime(period_fmt)
+                        if period != last_period:
+                            last_period = period
+                            if backup_id not in keep:
+                                keep.add(backup_id)
+                                kept += 1
+                to_delete = [backup_id for backup_id, _ in backups if backup_id not in keep]
+                
+                if to_delete:
+                    released = {}
+                    # IN lists stay within SQLite's bound-parameter limit
+                    for i in range(0, len(to_delete), self.SQL_PARAM_BATCH):
+                        ids = to_delete[i:i + self.SQL_PARAM_BATCH]
+                        placeholders = ','.join('?' * len(ids))
+                        c.execute(f'SELECT chunk_ids FROM backups WHERE id IN ({placeholders})', ids)
+                        for (chunk_ids,) in c.fetchall():
+                            for digest, count in unpack_refs(chunk_ids):
+                                released[digest] = released.get(digest, 0) + count
+                        c.execute(f'DELETE FROM backups WHERE id IN ({placeholders})', ids)
+                        c.execute(f'DELETE FROM backup_files WHERE backup_id IN ({placeholders})', ids)
+                    c.executemany('UPDATE chunks SET refs = refs - ? WHERE hash = ?',
+                                  ((n, digest) for digest, n in released.items()))
+                    c.execute('SELECT hash FROM chunks WHERE refs <= 0')
+                    orphans = [row[0] for row in c.fetchall()]
+                    # No generation bump: deletions only add Bloom false
+                    # positives, which are confirmed in SQL anyway
+                    c.execute('DELETE FROM chunks WHERE refs <= 0')
+            
+            # Only drop objects once no committed row can point at them
+            if to_delete:
+                for digest in orphans:
+                    self._object_path(digest).unlink(missing_ok=True)
+            return len(to_delete)
     
     def verify(self, backup_id: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT chunk_ids FROM backups WHERE id = ?', (backup_id,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
-            return False
-        
-        chunk_refs = json.loads(row[0])
-        for sha256 in chunk_refs.keys():
-            c.execute('SELECT sha256 FROM chunks WHERE sha256 = ?', (sha256,))
-            if not c.fetchone():
-                conn.close()
+        with self._transaction('BEGIN', read=True) as c:
+            c.execute('SELECT chunk_ids FROM backups WHERE id = ?', (backup_id,))
+            row = c.fetchone()
+            if not row:
                 return False
-        
-        conn.close()
-        return True
+            
+            # One set-difference query instead of a lookup per chunk
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS verify_need (hash BLOB PRIMARY KEY) WITHOUT ROWID')
+            c.execute('DELETE FROM verify_need')
+            # The same pass checks that each referenced object is on disk
+            digests = []
+            for digest, _ in unpack_refs(row[0]):
+                if not self._object_path(digest).is_file():
+                    return False
+                digests.append((digest,))
+            c.executemany('INSERT OR IGNORE INTO verify_need VALUES (?)', digests)
+            c.execute('SELECT 1 FROM verify_need WHERE hash NOT IN (SELECT hash FROM chunks) LIMIT 1')
+            return c.fetchone() is None
     
     def get_stats(self) -> Dict:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM chunks')
-        total_chunks = c.fetchone()[0]
-        c.execute('SELECT SUM(size), SUM(compressed_size) FROM chunks')
-        row = c.fetchone()
+        with self._read_lock:
+            c = self._read_conn.cursor()
+            c.execute('SELECT COUNT(*) FROM chunks')
+            total_chunks = c.fetchone()[0]
+            c.execute('SELECT SUM(size), SUM(compressed_size) FROM chunks')
+            row = c.fetchone()
         total_size = row[0] or 0
         compressed_total = row[1] or 0
         
         dedup_ratio = compressed_total / total_size if total_size > 0 else 1.0
         space_saved = total_size - compressed_total
         
-        conn.close()
         return {
             "total_chunks": total_chunks,
             "total_size_bytes": total_size,
@@ -0,0 +1,361 @@
+import os
+import random
+import threading
+from datetime import datetime
+
+import pytest
+from fastcdc.fastcdc_cy import fastcdc_cy
+
+import backup_engine
+from backup_engine import BackupEngine, ChunkBloom, _walk_files, unpack_refs
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+@pytest.fixture
+def source(tmp_path):
+    rng = random.Random(42)
+    src = tmp_path / "src"
+    _write(src / "random.bin", rng.randbytes(300_000))
+    _write(src / "text.txt", b"".join(b"line %d of some text\n" % (i % 500) for i in range(20_000)))
+    _write(src / "sub" / "repeated.bin", rng.randbytes(40_000) * 4)
+    _write(src / "empty", b"")
+    return src
+
+
+def _restored(out_dir, path):
+    return out_dir / path.relative_to(path.anchor)
+
+
+def _refs_by_chunk(engine):
+    return dict(engine._conn.execute('SELECT hash, refs FROM chunks'))
+
+
+def _object_count(engine):
+    return sum(len(names) for _, _, names in os.walk(engine.objects_path))
+
+
+@pytest.mark.parametrize("compression", ["zstd", "lz4", "zlib", "none"])
+def test_restore_round_trip(tmp_path, source, compression):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups", compression=compression)
+    backup_id = engine.run_backup(job_id)
+
+    out = tmp_path / "out"
+    assert engine.restore(backup_id, str(out))
+    for path in source.rglob("*"):
+        if path.is_file():
+            assert _restored(out, path).read_bytes() == path.read_bytes()
+    assert engine.verify(backup_id)
+
+
+@pytest.mark.parametrize("compression", ["zstd", "lz4", "zlib", "none"])
+@pytest.mark.parametrize("damage", ["flip", "truncate", "empty"])
+def test_restore_rejects_corrupt_object(tmp_path, source, compression, damage):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups", compression=compression)
+    backup_id = engine.run_backup(job_id)
+
+    # Damage every object, so compressed ones are hit whatever the codec
+    for obj_path in engine.objects_path.rglob("*"):
+        if obj_path.is_file():
+            obj = bytearray(obj_path.read_bytes())
+            if damage == "flip":
+                obj[len(obj) // 2] ^= 0xFF
+            elif damage == "truncate":
+                del obj[len(obj) // 2:]
+            else:
+                obj.clear()
+            obj_path.write_bytes(obj)
+    assert not engine.restore(backup_id, str(tmp_path / "out"))
+
+
+def test_restore_stays_in_output_dir(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+    engine._conn.execute("UPDATE backup_files SET path = '/a/../../../escaped/' || path")
+
+    assert not engine.restore(backup_id, str(tmp_path / "out" / "nested"))
+    assert not (tmp_path / "escaped").exists()
+    assert not (tmp_path / "out").exists()
+
+
+def test_window_boundaries_match_whole_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_engine, "CDC_WINDOW", 100_000)
+    data = random.Random(1).randbytes(1_000_003)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+
+    chunks = list(backup_engine.fastcdc(path, 2048, 8192, 65536, fat=True))
+    expected = [(c.offset, c.length) for c in fastcdc_cy(data, 2048, 8192, 65536)]
+    assert [(offset, length) for offset, length, _ in chunks] == expected
+    assert b"".join(bytes(chunk) for _, _, chunk in chunks) == data
+
+
+def test_bloom_mode_dedups(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    engine.MAX_KNOWN_CHUNKS = 0
+    job_id = engine.create_job("job", [str(source)], "/backups", compression="zlib")
+
+    engine.run_backup(job_id)
+    first = _refs_by_chunk(engine)
+    second_id = engine.run_backup(job_id)
+    assert engine.bloom_path.exists()
+    second = _refs_by_chunk(engine)
+    assert second.keys() == first.keys()
+    assert second == {digest: 2 * refs for digest, refs in first.items()}
+    assert _object_count(engine) == len(first)
+    assert engine.restore(second_id, str(tmp_path / "out"))
+
+
+def test_bloom_false_negatives_keep_refs(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    engine.MAX_KNOWN_CHUNKS = 0
+    job_id = engine.create_job("job", [str(source)], "/backups", compression="zlib")
+    engine.run_backup(job_id)
+    first = _refs_by_chunk(engine)
+
+    # An empty filter saved at the current generation misses every chunk
+    generation = engine._chunk_generation(engine._conn.cursor())
+    ChunkBloom(1 << 20).save(engine.bloom_path, generation)
+    engine.run_backup(job_id)
+    assert _refs_by_chunk(engine) == {digest: 2 * refs for digest, refs in first.items()}
+
+
+def test_bloom_load_rejects_other_generation(tmp_path):
+    path = tmp_path / "chunks.bloom"
+    bloom = ChunkBloom(1000)
+    bloom.add(bytes(32))
+    bloom.save(path, 3)
+
+    assert ChunkBloom.load(path, 4, 10) is None
+    loaded = ChunkBloom.load(path, 3, 10)
+    assert bytes(32) in loaded
+
+
+def test_prune_gfs_and_reclaim(tmp_path):
+    src = tmp_path / "src"
+    _write(src / "shared.bin", random.Random(0).randbytes(100_000))
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(src)], "/backups", compression="zlib")
+
+    days = ["2026-01-05", "2026-01-31", "2026-02-10", "2026-02-28", "2026-03-15",
+            "2026-03-20", "2026-03-22", "2026-03-29", "2026-03-30", "2026-03-31"]
+    backup_days = {}
+    for i, day in enumerate(days):
+        _write(src / "changing.bin", random.Random(i + 1).randbytes(50_000))
+        backup_id = engine.run_backup(job_id)
+        engine._conn.execute('UPDATE backups SET timestamp = ? WHERE id = ?',
+                             (datetime.fromisoformat(day + "T12:00").timestamp(), backup_id))
+        backup_days[backup_id] = day
+    chunks_before = len(_refs_by_chunk(engine))
+
+    assert engine.prune(job_id, keep_daily=3, keep_weekly=2, keep_monthly=2) == 3
+    kept = {backup_days[b["id"]] for b in engine.list_backups(job_id)}
+    # daily: the last three days; weekly: ISO weeks 12 and 11 (13 and 14 were
+    # already kept by daily); monthly: February and January
+    assert kept == {"2026-03-31", "2026-03-30", "2026-03-29", "2026-03-22", "2026-03-15",
+                    "2026-02-28", "2026-01-31"}
+
+    expected_refs = {}
+    for (chunk_ids,) in engine._conn.execute('SELECT chunk_ids FROM backups'):
+        for digest, count in unpack_refs(chunk_ids):
+            expected_refs[digest] = expected_refs.get(digest, 0) + count
+    assert _refs_by_chunk(engine) == expected_refs
+    assert len(expected_refs) < chunks_before
+    assert _object_count(engine) == len(expected_refs)
+    assert engine._conn.execute('SELECT COUNT(*) FROM backup_files').fetchone()[0] == 2 * len(kept)
+
+
+def test_walk_files_prunes_excluded(tmp_path):
+    for name in ["keep.txt", "skip.tmp", "cache/inner/deep.txt", "sub/keep2.txt", "sub/cache/x.txt"]:
+        _write(tmp_path / "src" / name, b"x")
+
+    files = _walk_files([str(tmp_path / "src")], ["*.tmp", "*/cache"])
+    assert sorted(files) == sorted(str(tmp_path / "src" / name) for name in ["keep.txt", "sub/keep2.txt"])
+
+
+def test_walk_files_records_absolute_paths(tmp_path, monkeypatch):
+    _write(tmp_path / "src" / "a.txt", b"x")
+    monkeypatch.chdir(tmp_path)
+
+    assert _walk_files(["src"]) == [str(tmp_path / "src" / "a.txt")]
+
+
+def test_insert_chunks_unrolled_batches(tmp_path):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    # Two full multi-VALUES batches plus an executemany remainder
+    rows = [(os.urandom(32), 8192, 4000 + i, 1) for i in range(2 * engine.CHUNK_INSERT_BATCH + 7)]
+    with engine._transaction() as c:
+        engine._insert_chunks(c, rows)
+
+    stored = {row[0]: row[1:] for row in engine._conn.execute('SELECT * FROM chunks')}
+    assert stored == {digest: (size, csize, refs) for digest, size, csize, refs in rows}
+
+    with engine._transaction() as c:
+        engine._insert_chunks(c, rows)
+    assert set(_refs_by_chunk(engine).values()) == {2}
+
+
+def test_verify_detects_missing_chunk(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+    assert engine.verify(backup_id)
+    assert not engine.verify("no-such-backup")
+
+    engine._conn.execute('DELETE FROM chunks WHERE hash = (SELECT hash FROM chunks LIMIT 1)')
+    assert not engine.verify(backup_id)
+
+
+def test_reads_do_not_wait_for_a_backup(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+
+    results = {}
+
+    def read():
+        results["backups"] = engine.list_backups()
+        results["stats"] = engine.get_stats()
+        results["verify"] = engine.verify(backup_id)
+        results["restore"] = engine.restore(backup_id, str(tmp_path / "out"))
+
+    # Hold the write transaction, as a running backup does
+    with engine._transaction():
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(timeout=10)
+        assert not reader.is_alive()
+    assert [b["id"] for b in results["backups"]] == [backup_id]
+    assert results["stats"]["total_chunks"] > 0
+    assert results["verify"] and results["restore"]
+
+
+def test_objects_are_synced_before_commit(tmp_path, source, monkeypatch):
+    synced = []
+    monkeypatch.setattr(backup_engine, "_fsync_dir", synced.append)
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    engine.run_backup(job_id)
+
+    shards = {path.parent for path in engine.objects_path.rglob("*") if path.is_file()}
+    assert shards | {engine.objects_path} == set(synced)
+    assert not list(engine.objects_path.rglob("*.tmp"))
+
+    # Rewriting an object replaces it whole
+    digest = next(iter(_refs_by_chunk(engine)))
+    engine._write_object(digest, b"\x00new")
+    assert engine._object_path(digest).read_bytes() == b"\x00new"
+
+
+def test_verify_detects_missing_object(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+
+    next(p for p in engine.objects_path.rglob("*") if p.is_file()).unlink()
+    assert not engine.verify(backup_id)
+    assert not engine.restore(backup_id, str(tmp_path / "out"))
+
+
+def test_bloom_filter_survives_prune(tmp_path, source):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    engine.MAX_KNOWN_CHUNKS = 0
+    job_id = engine.create_job("job", [str(source)], "/backups", compression="zlib")
+    engine.run_backup(job_id)
+    _write(source / "random.bin", random.Random(7).randbytes(300_000))
+    engine.run_backup(job_id)
+    engine.run_backup(job_id)
+    chunks_before = len(_refs_by_chunk(engine))
+
+    assert engine.prune(job_id, keep_daily=1, keep_weekly=0, keep_monthly=0) == 2
+    c = engine._conn.cursor()
+    chunk_count = c.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+    assert chunk_count < chunks_before
+    bloom = ChunkBloom.load(engine.bloom_path, engine._chunk_generation(c), chunk_count)
+    assert bloom is not None
+    assert all(digest in bloom for digest in _refs_by_chunk(engine))
+
+
+
+def _track_store_tasks(monkeypatch):
+    """Record the second-pass (_store_chunks) tasks run_backup submits."""
+    tasks = []
+    real_map = backup_engine._bounded_map
+
+    def bounded_map(ex, fn, arg_tuples, window):
+        if getattr(fn, "func", None) is backup_engine._store_chunks:
+            arg_tuples = list(arg_tuples)
+            tasks.extend(arg_tuples)
+        return real_map(ex, fn, arg_tuples, window)
+
+    monkeypatch.setattr(backup_engine, "_bounded_map", bounded_map)
+    return tasks
+
+
+def _saturated_bloom():
+    bloom = ChunkBloom(1024)
+    bloom.bits[:] = b"\xff" * len(bloom.bits)
+    return bloom
+
+
+def test_new_chunks_are_read_once(tmp_path, source, monkeypatch):
+    tasks = _track_store_tasks(monkeypatch)
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    engine.run_backup(job_id)
+    assert tasks == []
+
+    # An unchanged source rewrites no objects
+    mtimes = {p: p.stat().st_mtime_ns for p in engine.objects_path.rglob("*") if p.is_file()}
+    backup_id = engine.run_backup(job_id)
+    assert {p: p.stat().st_mtime_ns for p in engine.objects_path.rglob("*") if p.is_file()} == mtimes
+    assert tasks == []
+    assert engine.restore(backup_id, str(tmp_path / "out"))
+
+
+def test_filter_false_positives_are_stored(tmp_path, source, monkeypatch):
+    tasks = _track_store_tasks(monkeypatch)
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    # A filter that claims every chunk is stored sends all of them to the
+    # second pass
+    monkeypatch.setattr(engine, "_load_bloom", lambda c, generation, chunk_count: _saturated_bloom())
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+
+    assert tasks
+    assert _object_count(engine) == len(_refs_by_chunk(engine))
+    out = tmp_path / "out"
+    assert engine.restore(backup_id, str(out))
+    for path in source.rglob("*"):
+        if path.is_file():
+            assert _restored(out, path).read_bytes() == path.read_bytes()
+
+
+def test_file_changed_during_backup_is_redone(tmp_path, source, monkeypatch):
+    engine = BackupEngine(tmp_path / "repo" / "backups.db")
+    monkeypatch.setattr(engine, "_load_bloom", lambda c, generation, chunk_count: _saturated_bloom())
+    changing = source / "random.bin"
+    real_map = backup_engine._bounded_map
+
+    def bounded_map(ex, fn, arg_tuples, window):
+        if getattr(fn, "func", None) is backup_engine._store_chunks:
+            # The file changes after it was hashed, before its chunks are stored
+            _write(changing, random.Random(99).randbytes(300_000))
+        return real_map(ex, fn, arg_tuples, window)
+
+    monkeypatch.setattr(backup_engine, "_bounded_map", bounded_map)
+    job_id = engine.create_job("job", [str(source)], "/backups")
+    backup_id = engine.run_backup(job_id)
+
+    out = tmp_path / "out"
+    assert engine.restore(backup_id, str(out))
+    assert _restored(out, changing).read_bytes() == changing.read_bytes()
+    assert engine.verify(backup_id)
+    # Chunks stored for the old contents are not left behind
+    assert _object_count(engine) == len(_refs_by_chunk(engine))